@@ -5,19 +5,33 @@ Compares two HTML files and creates an interactive side-by-side view with highli
 """
 
 import sys
+from functools import lru_cache
 from bs4 import BeautifulSoup
-from difflib import SequenceMatcher, unified_diff
+from bs4.builder import builder_registry
+from difflib import SequenceMatcher
 import re
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlsplit, uses_params
 import html
 import difflib
 
+# Prefer the libxml2-backed tree builder when bs4 has one registered
+HTML_PARSER = 'lxml' if builder_registry.lookup('lxml') else 'html.parser'
+
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:
+    Indel = None
+
+# Without rapidfuzz, the 'ratio' method compares at most this many leading
+# characters of each text
+MAX_RATIO_CHARS = 20000
+
 def load_html_from_file(filepath):
     """Load and parse HTML from a file."""
     try:
         with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
             content = f.read()
-        return BeautifulSoup(content, 'html.parser')
+        return BeautifulSoup(content, HTML_PARSER)
     except Exception as e:
         print(f"Error loading {filepath}: {e}")
         return None
@@ -27,19 +41,19 @@ def extract_content_after_marker(soup, marker_text):
     if not soup:
         return None
     
-    # Find elements containing the marker
-    found_elements = []
+    # Find the first element containing the marker
+    marker_lc = marker_text.lower()
+    marker_elem = None
     for element in soup.find_all(['b', 'strong', 'h1', 'h2', 'h3', 'h4', 'p', 'font']):
-        if marker_text.lower() in element.get_text().lower():
-            found_elements.append(element)
+        if marker_lc in element.get_text().lower():
+            marker_elem = element
+            break
     
-    if not found_elements:
+    if marker_elem is None:
         print(f"Warning: Marker '{marker_text}' not found in page")
         # Return body content as fallback
         return soup.body if soup.body else soup
     
-    # Use the first found marker
-    marker_elem = found_elements[0]
     print(f"   Found marker in <{marker_elem.name}> tag")
     
     # Collect all content after the marker
@@ -78,16 +92,14 @@ def extract_text_blocks(element):
     if not element:
         return blocks
     
-    # Process each major element
-    for child in element.descendants:
-        if child.name in ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'td', 'th', 'div']:
-            text = child.get_text(strip=True)
-            if text and len(text) > 10:  # Filter out very short text
-                blocks.append({
-                    'tag': child.name,
-                    'text': text,
-                    'html': str(child)
-                })
+    # Process each major element (select walks the tree once, in document order)
+    for child in element.select('p, h1, h2, h3, h4, h5, h6, li, td, th, div'):
+        text = child.get_text(strip=True)
+        if text and len(text) > 10:  # Filter out very short text
+            blocks.append({
+                'tag': child.name,
+                'text': text
+            })
     
     return blocks
 
@@ -108,6 +120,7 @@ def extract_links(element):
     
     return links
 
+@lru_cache(maxsize=4096)
 def normalize_url(url, base_url=''):
     """Normalize a URL for comparison."""
     if url.startswith('http://') or url.startswith('https://'):
@@ -117,30 +130,43 @@ def normalize_url(url, base_url=''):
     else:
         absolute_url = url
     
-    parsed = urlparse(absolute_url)
-    normalized = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
+    parsed = urlsplit(absolute_url)
+    # Drop ;params from the last path segment (e.g. ;jsessionid=...), as urlparse
+    # does for the schemes that use them
+    path = parsed.path
+    if parsed.scheme in uses_params:
+        params_start = path.find(';', max(path.rfind('/'), 0))
+        if params_start >= 0:
+            path = path[:params_start]
+    normalized = f"{parsed.scheme}://{parsed.netloc}{path}"
     if parsed.query:
         normalized += f"?{parsed.query}"
     
     return normalized.rstrip('/').lower()
 
-def compare_links(links1, links2, base_url1='', base_url2=''):
-    """Compare two sets of links."""
-    norm_links1 = {}
-    for link in links1:
+def normalize_links(links, base_url=''):
+    """Map normalized URL to link for a list of links."""
+    try:
+        return {normalize_url(link['url'], base_url): link for link in links if link.get('url')}
+    except ValueError:
+        pass
+    
+    # Rare malformed URL (e.g. a broken IPv6 host): redo per link, skipping bad ones
+    norm_links = {}
+    for link in links:
+        if not link.get('url'):
+            continue
         try:
-            norm_url = normalize_url(link['url'], base_url1)
-            norm_links1[norm_url] = link
-        except:
+            norm_links[normalize_url(link['url'], base_url)] = link
+        except ValueError:
             pass
     
-    norm_links2 = {}
-    for link in links2:
-        try:
-            norm_url = normalize_url(link['url'], base_url2)
-            norm_links2[norm_url] = link
-        except:
-            pass
+    return norm_links
+
+def compare_links(links1, links2, base_url1='', base_url2=''):
+    """Compare two sets of links."""
+    norm_links1 = normalize_links(links1, base_url1)
+    norm_links2 = normalize_links(links2, base_url2)
     
     keys1 = set(norm_links1.keys())
     keys2 = set(norm_links2.keys())
@@ -157,18 +183,15 @@ def compare_links(links1, links2, base_url1='', base_url2=''):
         'total_v2': len(keys2)
     }
 
-def generate_side_by_side_html(content1, content2):
+def generate_side_by_side_html(html1, html2):
     """Generate side-by-side HTML with diff highlighting."""
-    if not content1 or not content2:
+    if not html1 or not html2:
         return "<p>No content to compare</p>", "<p>No content to compare</p>"
     
-    # Get the HTML strings
-    html1 = str(content1)
-    html2 = str(content2)
-    
-    # Split into lines for comparison
-    lines1 = html1.split('\n')
-    lines2 = html2.split('\n')
+    # Split into lines for comparison, one tag per line so long serialized
+    # lines don't turn the line diff into a whole-string diff
+    lines1 = re.sub(r'>\s*<', '>\n<', html1).split('\n')
+    lines2 = re.sub(r'>\s*<', '>\n<', html2).split('\n')
     
     # Use difflib to generate HTML diff
     differ = difflib.HtmlDiff(wrapcolumn=80)
@@ -181,15 +204,24 @@ def generate_side_by_side_html(content1, content2):
     return diff_table
 
 def generate_text_diff_view(text1, text2):
-    """Generate a character-level diff visualization."""
-    matcher = SequenceMatcher(None, text1, text2)
+    """Generate a word-level diff visualization."""
+    if text1 == text2:
+        escaped = html.escape(text1)
+        return escaped, escaped
+    
+    # Words and the whitespace between them, so joining tokens restores the text
+    tokens1 = re.findall(r'\S+|\s+', text1)
+    tokens2 = re.findall(r'\S+|\s+', text2)
+    # autojunk ignores tokens that make up >1% of a 200+ token sequence (common
+    # words, repeated whitespace). Much faster, but those never anchor a match.
+    matcher = SequenceMatcher(None, tokens1, tokens2, autojunk=True)
     
     result_v1 = []
     result_v2 = []
     
     for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-        text1_part = text1[i1:i2]
-        text2_part = text2[j1:j2]
+        text1_part = ''.join(tokens1[i1:i2])
+        text2_part = ''.join(tokens2[j1:j2])
         
         if tag == 'equal':
             result_v1.append(html.escape(text1_part))
@@ -204,62 +236,98 @@ def generate_text_diff_view(text1, text2):
     
     return ''.join(result_v1), ''.join(result_v2)
 
-def calculate_similarity(text1, text2):
-    """Calculate similarity between two texts."""
-    matcher = SequenceMatcher(None, text1, text2)
-    return matcher.ratio()
+def get_shingles(text, n=2):
+    """Return the set of n-word shingles (runs of n consecutive words) in a text."""
+    words = text.split()
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
 
-def generate_enhanced_report(file1, file2, content1, content2, links1, links2, 
-                            link_comparison, text1, text2, marker):
-    """Generate an enhanced HTML report with side-by-side comparison."""
-    
-    similarity = calculate_similarity(text1, text2)
-    
-    # Generate diff views
-    v1_diff, v2_diff = generate_text_diff_view(text1[:5000], text2[:5000])
-    
-    html_output = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <title>Side-by-Side HTML Comparison</title>
-    <style>
-        * {{
+def calculate_similarity(text1, text2, method='jaccard'):
+    """Calculate similarity between two texts.
+    
+    'jaccard' is the Jaccard index of the texts' word-bigram shingle sets
+    (linear time). Shared vocabulary alone scores near 0, so it runs lower
+    than a character-level ratio for the same pages. 'ratio' compares the
+    texts' lines with rapidfuzz's Indel similarity when available, else with
+    SequenceMatcher on the first MAX_RATIO_CHARS characters. The two
+    'ratio' backends give different scores for the same texts: Indel counts
+    longest-common-subsequence matches over the whole text, SequenceMatcher
+    counts Ratcliff/Obershelp matching blocks.
+    """
+    if text1 == text2:
+        return 1.0
+    
+    if method == 'jaccard':
+        shingles1 = get_shingles(text1)
+        shingles2 = get_shingles(text2)
+        union = shingles1 | shingles2
+        if not union:
+            # Fewer than two words on each side
+            return 1.0 if text1.split() == text2.split() else 0.0
+        return len(shingles1 & shingles2) / len(union)
+    elif method == 'ratio':
+        if Indel is not None:
+            # 2*LCS/total in C++; not the same score as SequenceMatcher.ratio()
+            return Indel.normalized_similarity(text1.splitlines(), text2.splitlines())
+        # Cap the input to bound the worst case; see generate_text_diff_view
+        # for the autojunk tradeoff
+        matcher = SequenceMatcher(None, text1[:MAX_RATIO_CHARS].splitlines(),
+                                  text2[:MAX_RATIO_CHARS].splitlines(), autojunk=True)
+        # quick_ratio() is a linear upper bound on ratio(); skip the full match
+        # when it already rules out any common line
+        if matcher.quick_ratio() == 0:
+            return 0.0
+        return matcher.ratio()
+    else:
+        raise ValueError(f"Unknown similarity method: {method}")
+
+def generate_link_items(links, css_class):
+    """Render links as list items for the report."""
+    # Element content only, so quotes need no escaping: 3 replace passes instead of 5
+    escape = html.escape
+    parts = []
+    for link in links:
+        parts.append(f'<li class="{css_class}"><div class="link-text">{escape(link.get("text", "(no text)"), quote=False)}</div>'
+                     f'<div class="link-url">🔗 {escape(link["url"], quote=False)}</div></li>')
+    return ''.join(parts)
+
+# Stylesheet for generate_enhanced_report, kept out of the f-string so its
+# braces need no escaping
+REPORT_CSS = """\
+        * {
             box-sizing: border-box;
-        }}
+        }
         
-        body {{
+        body {
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
             margin: 0;
             padding: 0;
             background: #f5f5f5;
-        }}
+        }
         
-        .header {{
+        .header {
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             color: white;
             padding: 30px;
             box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }}
+        }
         
-        .header h1 {{
+        .header h1 {
             margin: 0 0 10px 0;
             font-size: 2.5em;
-        }}
+        }
         
-        .header p {{
+        .header p {
             margin: 5px 0;
             opacity: 0.9;
-        }}
+        }
         
-        .container {{
+        .container {
             max-width: 1800px;
             margin: 0 auto;
             padding: 20px;
-        }}
+        }
         
-        .stats-bar {{
+        .stats-bar {
             background: white;
             padding: 20px;
             border-radius: 10px;
@@ -269,40 +337,40 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
             justify-content: space-around;
             flex-wrap: wrap;
             gap: 15px;
-        }}
+        }
         
-        .stat-box {{
+        .stat-box {
             text-align: center;
             padding: 15px 25px;
             background: linear-gradient(135deg, #f5f7fa 0%, #c3cfe2 100%);
             border-radius: 8px;
             min-width: 140px;
-        }}
+        }
         
-        .stat-label {{
+        .stat-label {
             font-size: 0.85em;
             color: #666;
             text-transform: uppercase;
             letter-spacing: 1px;
             margin-bottom: 5px;
-        }}
+        }
         
-        .stat-value {{
+        .stat-value {
             font-size: 2em;
             font-weight: bold;
             color: #2c3e50;
-        }}
+        }
         
-        .similarity-bar {{
+        .similarity-bar {
             width: 100%;
             height: 40px;
             background: #e0e0e0;
             border-radius: 20px;
             overflow: hidden;
             margin: 20px 0;
-        }}
+        }
         
-        .similarity-fill {{
+        .similarity-fill {
             height: 100%;
             background: linear-gradient(90deg, #e74c3c 0%, #f39c12 30%, #f1c40f 50%, #2ecc71 100%);
             display: flex;
@@ -312,9 +380,9 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
             font-weight: bold;
             font-size: 1.1em;
             transition: width 1s ease;
-        }}
+        }
         
-        .tabs {{
+        .tabs {
             display: flex;
             gap: 10px;
             margin-bottom: 20px;
@@ -322,9 +390,9 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
             padding: 15px;
             border-radius: 10px;
             box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }}
+        }
         
-        .tab {{
+        .tab {
             padding: 12px 25px;
             background: #f0f0f0;
             border: none;
@@ -333,68 +401,68 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
             font-size: 1em;
             font-weight: 600;
             transition: all 0.3s ease;
-        }}
+        }
         
-        .tab:hover {{
+        .tab:hover {
             background: #e0e0e0;
-        }}
+        }
         
-        .tab.active {{
+        .tab.active {
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             color: white;
-        }}
+        }
         
-        .tab-content {{
+        .tab-content {
             display: none;
             background: white;
             padding: 30px;
             border-radius: 10px;
             box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }}
+        }
         
-        .tab-content.active {{
+        .tab-content.active {
             display: block;
-        }}
+        }
         
-        .comparison-grid {{
+        .comparison-grid {
             display: grid;
             grid-template-columns: 1fr 1fr;
             gap: 20px;
             margin-top: 20px;
-        }}
+        }
         
-        .version-panel {{
+        .version-panel {
             background: #fafafa;
             border-radius: 10px;
             padding: 20px;
             border: 2px solid #e0e0e0;
-        }}
+        }
         
-        .version-panel.v1 {{
+        .version-panel.v1 {
             border-left: 4px solid #e74c3c;
-        }}
+        }
         
-        .version-panel.v2 {{
+        .version-panel.v2 {
             border-left: 4px solid #2ecc71;
-        }}
+        }
         
-        .panel-header {{
+        .panel-header {
             font-size: 1.3em;
             font-weight: bold;
             margin-bottom: 15px;
             padding-bottom: 10px;
             border-bottom: 2px solid #e0e0e0;
-        }}
+        }
         
-        .version-panel.v1 .panel-header {{
+        .version-panel.v1 .panel-header {
             color: #e74c3c;
-        }}
+        }
         
-        .version-panel.v2 .panel-header {{
+        .version-panel.v2 .panel-header {
             color: #2ecc71;
-        }}
+        }
         
-        .content-box {{
+        .content-box {
             background: white;
             padding: 20px;
             border-radius: 8px;
@@ -405,166 +473,195 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
             line-height: 1.6;
             white-space: pre-wrap;
             word-wrap: break-word;
-        }}
+        }
         
-        .diff-removed {{
+        .diff-removed {
             background: #ffecec;
             color: #c0392b;
             padding: 2px 4px;
             border-radius: 3px;
             text-decoration: line-through;
-        }}
+        }
         
-        .diff-added {{
+        .diff-added {
             background: #e8f5e9;
             color: #27ae60;
             padding: 2px 4px;
             border-radius: 3px;
             font-weight: 600;
-        }}
+        }
         
-        .diff-changed {{
+        .diff-changed {
             background: #fff3cd;
             color: #856404;
             padding: 2px 4px;
             border-radius: 3px;
-        }}
+        }
         
-        .link-list {{
+        .link-list {
             list-style: none;
             padding: 0;
             margin: 0;
-        }}
+        }
         
-        .link-item {{
+        .link-item {
             padding: 12px;
             margin: 8px 0;
             background: white;
             border-radius: 6px;
             border-left: 4px solid #3498db;
             transition: all 0.3s ease;
-        }}
+        }
         
-        .link-item:hover {{
+        .link-item:hover {
             transform: translateX(5px);
             box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-        }}
+        }
         
-        .link-item.removed {{
+        .link-item.removed {
             border-left-color: #e74c3c;
             background: #ffebee;
-        }}
+        }
         
-        .link-item.added {{
+        .link-item.added {
             border-left-color: #2ecc71;
             background: #e8f5e9;
-        }}
+        }
         
-        .link-text {{
+        .link-text {
             font-weight: 600;
             color: #2c3e50;
             margin-bottom: 4px;
-        }}
+        }
         
-        .link-url {{
+        .link-url {
             font-family: 'Courier New', monospace;
             font-size: 0.85em;
             color: #7f8c8d;
             word-break: break-all;
-        }}
+        }
         
-        .section-title {{
+        .section-title {
             font-size: 1.5em;
             font-weight: bold;
             margin: 30px 0 15px 0;
             color: #2c3e50;
             border-bottom: 3px solid #3498db;
             padding-bottom: 10px;
-        }}
+        }
         
-        .badge {{
+        .badge {
             display: inline-block;
             padding: 4px 10px;
             border-radius: 12px;
             font-size: 0.8em;
             font-weight: 600;
             margin-left: 10px;
-        }}
+        }
         
-        .badge-danger {{
+        .badge-danger {
             background: #e74c3c;
             color: white;
-        }}
+        }
         
-        .badge-success {{
+        .badge-success {
             background: #2ecc71;
             color: white;
-        }}
+        }
         
-        .badge-info {{
+        .badge-info {
             background: #3498db;
             color: white;
-        }}
+        }
         
-        table.diff {{
+        table.diff {
             width: 100%;
             border-collapse: collapse;
             font-family: 'Courier New', monospace;
             font-size: 0.85em;
-        }}
+        }
         
-        table.diff td {{
+        table.diff td {
             padding: 4px 8px;
             vertical-align: top;
-        }}
+        }
         
-        table.diff .diff_header {{
+        table.diff .diff_header {
             background: #e0e0e0;
             font-weight: bold;
             text-align: center;
-        }}
+        }
         
-        table.diff .diff_next {{
+        table.diff .diff_next {
             background: #f0f0f0;
-        }}
+        }
         
-        .note {{
+        .note {
             background: #fff3cd;
             border-left: 4px solid #ffc107;
             padding: 15px;
             margin: 20px 0;
             border-radius: 5px;
-        }}
+        }
         
-        .legend {{
+        .legend {
             display: flex;
             gap: 20px;
             margin: 20px 0;
             padding: 15px;
             background: #f8f9fa;
             border-radius: 8px;
-        }}
+        }
         
-        .legend-item {{
+        .legend-item {
             display: flex;
             align-items: center;
             gap: 8px;
-        }}
+        }
         
-        .legend-box {{
+        .legend-box {
             width: 20px;
             height: 20px;
             border-radius: 4px;
-        }}
+        }
         
-        .scrollable-section {{
+        .scrollable-section {
             max-height: 500px;
             overflow-y: auto;
             padding: 15px;
             background: #fafafa;
             border-radius: 8px;
             margin: 10px 0;
-        }}
+        }"""
+
+def generate_enhanced_report(file1, file2, html1, html2, links1, links2, 
+                            link_comparison, text1, text2, marker):
+    """Generate an enhanced HTML report with side-by-side comparison."""
+    
+    similarity = calculate_similarity(text1, text2)
+    
+    # Generate diff views
+    v1_diff, v2_diff = generate_text_diff_view(text1[:5000], text2[:5000])
+    html_diff = generate_side_by_side_html(html1, html2)
+    
+    # Build the link lists once, before they go into the template
+    removed_items = (generate_link_items(link_comparison['only_in_v1'], 'link-item removed')
+                     or '<li class="link-item">No links removed</li>')
+    added_items = (generate_link_items(link_comparison['only_in_v2'], 'link-item added')
+                   or '<li class="link-item">No links added</li>')
+    in_both = link_comparison['in_both']
+    common_items = generate_link_items(in_both[:50], 'link-item')
+    if len(in_both) > 50:
+        common_items += f'<li class="link-item">... and {len(in_both) - 50} more</li>'
+    
+    html_output = f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Side-by-Side HTML Comparison</title>
+    <style>
+{REPORT_CSS}
     </style>
 </head>
 <body>
@@ -663,7 +760,7 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
                     </div>
                     <div class="scrollable-section">
                         <ul class="link-list">
-                            {''.join(f'<li class="link-item removed"><div class="link-text">{html.escape(link.get("text", "(no text)"))}</div><div class="link-url">🔗 {html.escape(link["url"])}</div></li>' for link in link_comparison['only_in_v1']) if link_comparison['only_in_v1'] else '<li class="link-item">No links removed</li>'}
+                            {removed_items}
                         </ul>
                     </div>
                 </div>
@@ -675,7 +772,7 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
                     </div>
                     <div class="scrollable-section">
                         <ul class="link-list">
-                            {''.join(f'<li class="link-item added"><div class="link-text">{html.escape(link.get("text", "(no text)"))}</div><div class="link-url">🔗 {html.escape(link["url"])}</div></li>' for link in link_comparison['only_in_v2']) if link_comparison['only_in_v2'] else '<li class="link-item">No links added</li>'}
+                            {added_items}
                         </ul>
                     </div>
                 </div>
@@ -687,8 +784,7 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
             </h3>
             <div class="scrollable-section">
                 <ul class="link-list">
-                    {''.join(f'<li class="link-item"><div class="link-text">{html.escape(link.get("text", "(no text)"))}</div><div class="link-url">🔗 {html.escape(link["url"])}</div></li>' for link in link_comparison['in_both'][:50])}
-                    {f'<li class="link-item">... and {len(link_comparison["in_both"]) - 50} more</li>' if len(link_comparison['in_both']) > 50 else ''}
+                    {common_items}
                 </ul>
             </div>
         </div>
@@ -700,7 +796,7 @@ def generate_enhanced_report(file1, file2, content1, content2, links1, links2,
                 Colors indicate additions, deletions, and changes.
             </div>
             <div style="overflow-x: auto;">
-                {generate_side_by_side_html(content1, content2)}
+                {html_diff}
             </div>
         </div>
         
@@ -806,8 +902,11 @@ def main():
     print(f"   In both: {len(link_comparison['in_both'])}")
     
     print("\n📄 Generating side-by-side report...")
+    # Serialize each tree once; only the HTML source diff needs the markup
+    html1 = str(content1) if content1 else ''
+    html2 = str(content2) if content2 else ''
     report = generate_enhanced_report(
-        file1, file2, content1, content2,
+        file1, file2, html1, html2,
         links1, links2, link_comparison,
         text1, text2, marker
     )